@@ -1,25 +1,33 @@
 """EfestoClient provides controlling Efesto heat devices
 """
-import warnings
+import http.client as http_client
 import logging
 import requests
 import socket
+import threading
+import time
+from collections import namedtuple
 from datetime import datetime, timedelta
+from enum import IntEnum
+from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
+from requests.packages import urllib3
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
+from requests.packages.urllib3.util.retry import Retry
 
 try:
-    import http.client as http_client
+    import orjson
+    _loads = orjson.loads
 except ImportError:
-    # Python 2
-    import httplib as http_client
+    import json
+    _loads = json.loads
 
 name = "efestoclient"
 
-"""Disable SSL verify warning because Efesto has self signed certificates"""
-warnings.simplefilter('ignore', InsecureRequestWarning)
+_warnings_disabled = False
 
-logging.basicConfig()
 _LOGGER = logging.getLogger(__name__)
+_LOGGER.addHandler(logging.NullHandler())
 
 HEADER_ACCEPT = (
     "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,"
@@ -32,6 +40,127 @@ HEADER = {
     'Accept': HEADER_ACCEPT,
     'Content-Type': HEADER_CONTENT_TYPE
 }
+RETRY_STATUSES = (302, 500, 502, 503, 504)
+
+
+class StoveStatus(IntEnum):
+    """Known Efesto stove status codes"""
+    OFF = 0
+    START = 1
+    LOAD_PELLETS = 2
+    FLAME_LIGHT = 3
+    ON = 4
+    CLEANING_FIRE_POT = 5
+    CLEANING_FINAL = 6
+    ECO_STOP = 7
+    NO_PELLETS = 9
+
+
+def _stove_status(code):
+    """Map a status code to StoveStatus, unknown codes are kept as int"""
+    try:
+        return StoveStatus(code)
+    except ValueError:
+        return code
+
+
+def _endpoints(url, deviceid):
+    """Login url, ajax url and referer of a device"""
+    return (url + '/en/login/',
+            url + '/en/ajax/action/frontend/response/ajax/',
+            url + '/en/heaters/action/manage/heater/' + deviceid + '/')
+
+
+def _webcall_payload(method, deviceid, params='1'):
+    """Form payload of an ajax webcall"""
+    return {
+        'method': method,
+        'params': params,
+        'device': deviceid
+    }
+
+
+def _parameters_payload(deviceid, air_temperature=None, power=None):
+    """Form payload of a write-parameters-queue webcall"""
+    params = {}
+    if air_temperature is not None:
+        params['set-air-temperature'] = air_temperature
+    if power is not None:
+        params['set-power'] = power
+    if not params:
+        raise Error("No parameters to set")
+
+    return _webcall_payload("write-parameters-queue", deviceid,
+                            urlencode(params))
+
+
+def _webcall_result(status_code, body):
+    """Turn a webcall response into an Efesto result payload"""
+    if status_code == 302:
+        return {
+            'status': 1,
+            'message': 'Efesto server is temporary unavailable ' +
+                       '(got temporary redirect)'
+        }
+    if status_code != 200:
+        return {
+            'status': 1,
+            'message': 'Efesto server is unavailable'
+        }
+    res = _loads(body)
+    if res is None:
+        return {
+            'status': 1,
+            'message': 'Unkown error at Efesto end'
+        }
+    return res
+
+
+def _backoff_delay(backoff, cap, attempt):
+    """Seconds to wait before retrying a webcall"""
+    return min(backoff * (2 ** attempt), cap)
+
+
+def _check_result(res):
+    """Raise Error when Efesto reports a failed webcall"""
+    if res['status'] > 0:
+        raise Error(str.format("{0}", res['message']))
+    return res
+
+
+def _check_parameters_result(res):
+    """Raise Error when a write-parameters-queue webcall failed"""
+    _check_result(res)
+
+    for key in res["message"]:
+        if (res["message"][key] > 0):
+            raise Error(str.format("{0}-failed", key))
+
+
+def _parse_status(deviceid, res, status_map):
+    """Build a Device from a get-state result payload"""
+    msg = _check_result(res)['message']
+    idle = res['idle']
+    status = _stove_status(msg['deviceStatus'])
+
+    return Device(
+        device_id=deviceid,
+        device_status=status,
+        device_status_human=status_map[status],
+        air_temperature=msg['airTemperature'],
+        smoke_temperature=msg['smokeTemperature'],
+        real_power=msg['realPower'],
+        last_set_air_temperature=msg['lastSetAirTemperature'],
+        last_set_power=msg['lastSetPower'],
+        idle_info=idle['idle_label'] if idle is not None else None)
+
+
+def _disable_insecure_warnings():
+    """Disable SSL verify warning because Efesto has self signed certificates"""
+    global _warnings_disabled
+    if not _warnings_disabled:
+        urllib3.disable_warnings(InsecureRequestWarning)
+        _warnings_disabled = True
 
 
 class EfestoClient(object):
@@ -44,7 +173,11 @@ class EfestoClient(object):
         16: "?", 17: "?", 18: "?", 19: "?"
     }
 
-    def __init__(self, url, username, password, deviceid, debug=False):
+    SYSTEM_MODES = tuple(statusTranslated.values())
+
+    def __init__(self, url, username, password, deviceid, debug=False,
+                 status_ttl=5.0, max_retries=3, backoff=0.25, cap=2.0,
+                 disable_ssl_warnings=True, trust_env=True):
         """EfestoClient object constructor"""
         if debug is True:
             _LOGGER.setLevel(logging.DEBUG)
@@ -66,41 +199,89 @@ class EfestoClient(object):
         self.password = password
         self.deviceid = deviceid
 
+        self._login_url, self._ajax_url, self._referer = \
+            _endpoints(url, deviceid)
+
+        self._payload_state = _webcall_payload('get-state', deviceid)
+        self._payload_off = _webcall_payload('heater-off', deviceid)
+        self._payload_on = _webcall_payload('heater-on', deviceid)
+
         self.phpsessid = None
         self.remember = None
-
-        self._login()
+        self._login_lock = threading.Lock()
+
+        self._status_ttl = status_ttl
+        self._status_cache = (0.0, None)
+        self._status_generation = 0
+        self._status_lock = threading.Lock()
+
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._cap = cap
+
+        if disable_ssl_warnings:
+            _disable_insecure_warnings()
+        self._session = requests.Session()
+        self._session.verify = False
+        # trust_env=False skips the per-request proxy environment and
+        # ~/.netrc lookups for callers that don't need them
+        self._session.trust_env = trust_env
+        self._session.headers.update(HEADER)
+        self._session.headers.update({'Origin': url, 'Referer': self._referer})
+        # Transport level retries only cover failed connections and 5xx on
+        # the login page; webcalls are retried by handle_webcall.
+        self._session.mount(self.url, HTTPAdapter(
+            pool_connections=2, pool_maxsize=4,
+            max_retries=Retry(total=max_retries, backoff_factor=backoff,
+                              status_forcelist=[502, 503, 504])))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        session = getattr(self, '_session', None)
+        if session is not None:
+            session.close()
+
+    def close(self):
+        """Close the HTTP session and its pooled connections"""
+        self._session.close()
 
     def _login(self):
         self.sessionid()
         self.login()
 
-    def _headers(self):
-        """Correctly set headers including cookies for requests to Efesto."""
-
-        if not self.phpsessid:
-            cookies = ''
-        else:
-            if not self.remember:
-                cookies = "PHPSESSID=" + self.phpsessid
-            else:
-                cookies = "PHPSESSID=" + self.phpsessid + "; remember=" \
-                          + self.remember
-
-        return {'Accept': HEADER_ACCEPT,
-                'Cookie': cookies,
-                'Content-Type': HEADER_CONTENT_TYPE,
-                'Origin': self.url,
-                'Referer': self.url + '/en/heaters/action/manage/heater/'
-                                    + self.deviceid + '/'}
+    def _ensure_logged_in(self):
+        with self._login_lock:
+            if self.remember is None:
+                self._login()
+
+    def _relogin(self, remember):
+        with self._login_lock:
+            # Skip when another webcall already logged in again meanwhile
+            if self.remember != remember:
+                return
+            # The new cookies replace the old ones in the session cookie jar
+            phpsessid = self.phpsessid
+            try:
+                self._login()
+            except Error:
+                # Keep the old session, so the next webcall does not turn an
+                # outage into a failed initial login.
+                self.phpsessid = phpsessid
+                self.remember = remember
+                raise
 
     def sessionid(self):
         """Get PHP session information"""
 
-        url = self.url + '/en/login/'
+        url = self._login_url
 
         try:
-            response = requests.get(url, headers=self._headers(), verify=False)
+            response = self._session.get(url)
             response.raise_for_status()
         except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             raise ConnectionError(str.format("Connection to {0} not possible", url))
@@ -114,7 +295,7 @@ class EfestoClient(object):
     def login(self):
         """Authenticate with username and password to Efesto"""
 
-        url = self.url + '/en/login/'
+        url = self._login_url
 
         payload = {
             'login[username]': self.username,
@@ -122,8 +303,8 @@ class EfestoClient(object):
         }
 
         try:
-            response = requests.post(url, data=payload, headers=self._headers(),
-                                    verify=False, allow_redirects=False)
+            response = self._session.post(url, data=payload,
+                                          allow_redirects=False)
             response.raise_for_status()
         except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             raise ConnectionError(str.format("Connection to {0} not possible", url))
@@ -137,195 +318,125 @@ class EfestoClient(object):
 
         return self.remember
 
+    def cache_clear(self):
+        """Invalidate the cached stove status"""
+        # Polls already in flight see the new generation and do not store
+        # their possibly outdated result.
+        self._status_generation += 1
+        self._status_cache = (0.0, None)
+
     def get_system_modes(self):
-        """Get list of system modes"""
-        statusList = []
-        for key in self.statusTranslated:
-            statusList.append(self.statusTranslated[key])
-        return statusList
+        """Get tuple of system modes"""
+        return self.SYSTEM_MODES
 
-    def handle_webcall(self, url, payload):
+    def _post(self, url, payload):
         try:
-            response = requests.post(url, data=payload, headers=self._headers(),
-                                    verify=False, allow_redirects=False)
-            response.raise_for_status()
+            return self._session.post(url, data=payload,
+                                      allow_redirects=False)
         except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             raise ConnectionError(str.format("Connection to {0} not possible", url))
         except requests.exceptions.RequestException:
             raise InvalidURLError(str.format("Invalid Efesto url: {0}", url))
 
-        if response.status_code == 200:
-            res = response.json()
-            if res is None:
-                returnpayload = {
-                    'status': 1,
-                    'message': 'Unkown error at Efesto end'
-                }
-            else:
-                returnpayload = res
-        elif response.status_code == 302:
-            returnpayload = {
-                'status': 1,
-                'message': 'Efesto server is temporary unavailable ' +
-                           '(got temporary redirect)'
-            }
-        else:
-            returnpayload = {
-                'status': 1,
-                'message': 'Efesto server is unavailable'
-            }
-        return returnpayload
+    def _retry_webcall(self, url, payload, response):
+        for attempt in range(self._max_retries):
+            if response.status_code not in RETRY_STATUSES:
+                break
+            time.sleep(_backoff_delay(self._backoff, self._cap, attempt))
+            response = self._post(url, payload)
+        return response
 
-    def get_status(self):
-        """Get stove status"""
+    def handle_webcall(self, url, payload):
+        if self.remember is None:
+            self._ensure_logged_in()
 
-        url = (self.url + "/en/ajax/action/frontend/response/ajax/")
+        remember = self.remember
+        response = self._post(url, payload)
+        if response.status_code == 302:
+            # Efesto also redirects when the session expired, so login again
+            # before spending the retry budget on the webcall.
+            try:
+                self._relogin(remember)
+            except Error:
+                return _webcall_result(302, None)
+            response = self._post(url, payload)
 
-        payload = {
-            'method': 'get-state',
-            'params': '1',
-            'device': self.deviceid
-        }
+        response = self._retry_webcall(url, payload, response)
 
-        res = self.handle_webcall(url, payload)
-        if res['status'] > 0:
-            raise Error(str.format("{0}", res['message']))
+        return _webcall_result(response.status_code, response.content)
 
-        idle_info = res['idle']['idle_label'] if res['idle'] is not None else None
+    def get_status(self):
+        """Get stove status, cached for status_ttl seconds"""
 
-        return Device(self.deviceid,
-                      res['message']['deviceStatus'],
-                      self.statusTranslated[res['message']['deviceStatus']],
-                      res['message']['airTemperature'],
-                      res['message']['smokeTemperature'],
-                      res['message']['realPower'],
-                      res['message']['lastSetAirTemperature'],
-                      res['message']['lastSetPower'],
-                      idle_info)
+        with self._status_lock:
+            now = time.monotonic()
+            if (self._status_cache[1] is not None
+                    and now - self._status_cache[0] < self._status_ttl):
+                return self._status_cache[1]
 
-    def set_off(self):
-        """Turn stove off"""
+            generation = self._status_generation
+            device = self._fetch_status()
+            if generation == self._status_generation:
+                self._status_cache = (now, device)
 
-        url = (self.url + "/en/ajax/action/frontend/response/ajax/")
+            return device
 
-        payload = {
-            'method': 'heater-off',
-            'params': '1',
-            'device': self.deviceid
-        }
+    def _fetch_status(self):
+        res = self.handle_webcall(self._ajax_url, self._payload_state)
+        return _parse_status(self.deviceid, res, self.statusTranslated)
 
-        res = self.handle_webcall(url, payload)
-        if res['status'] > 0:
-            raise Error(str.format("{0}", res['message']))
+    def set_off(self):
+        """Turn stove off"""
+
+        try:
+            res = self.handle_webcall(self._ajax_url, self._payload_off)
+        finally:
+            self.cache_clear()
+        _check_result(res)
 
         return True
 
     def set_on(self):
-        """Turn stove off"""
-
-        url = (self.url + "/en/ajax/action/frontend/response/ajax/")
-
-        payload = {
-            'method': "heater-on",
-            'params': "1",
-            'device': self.deviceid
-        }
+        """Turn stove on"""
 
-        res = self.handle_webcall(url, payload)
-        if res['status'] > 0:
-            raise Error(str.format("{0}", res['message']))
+        try:
+            res = self.handle_webcall(self._ajax_url, self._payload_on)
+        finally:
+            self.cache_clear()
+        _check_result(res)
 
         return True
 
-    def set_temperature(self, temperatureValue):
-        """Set desired room temperature"""
-
-        url = (self.url + "/en/ajax/action/frontend/response/ajax/")
+    def set_parameters(self, *, air_temperature=None, power=None):
+        """Set desired room temperature and/or power value in one call"""
 
-        payload = {
-            'method': "write-parameters-queue",
-            'params': "set-air-temperature=" + str(temperatureValue),
-            'device': self.deviceid
-        }
+        payload = _parameters_payload(self.deviceid, air_temperature, power)
 
-        res = self.handle_webcall(url, payload)
-        if res['status'] > 0:
-            raise Error(str.format("{0}", res['message']))
+        try:
+            res = self.handle_webcall(self._ajax_url, payload)
+        finally:
+            self.cache_clear()
+        _check_parameters_result(res)
 
-        for key in res["message"]:
-            if (res["message"][key] > 0):
-                raise Error(str.format("{0}-failed", key))
+    def set_temperature(self, temperatureValue):
+        """Set desired room temperature"""
+        self.set_parameters(air_temperature=temperatureValue)
 
     def set_power(self, powerValue):
         """Set desired power value"""
+        self.set_parameters(power=powerValue)
 
-        url = (self.url + "/en/ajax/action/frontend/response/ajax/")
-
-        payload = {
-            'method': "write-parameters-queue",
-            'params': "set-power=" + str(powerValue),
-            'device': self.deviceid
-        }
-
-        res = self.handle_webcall(url, payload)
-        if res['status'] > 0:
-            raise Error(str.format("{0}", res['message']))
 
-        for key in res["message"]:
-            if (res["message"][key] > 0):
-                raise Error(str.format("{0}-failed", key))
+class Device(namedtuple('Device', [
+        'device_id', 'device_status', 'device_status_human',
+        'air_temperature', 'smoke_temperature', 'real_power',
+        'last_set_air_temperature', 'last_set_power', 'idle_info'])):
+    """Efesto heating device representation"""
+    __slots__ = ()
 
 
-class Device(object):
-    """Efesto heating device representation"""
-    def __init__(self, device_id, device_status, device_status_human,
-                 air_temperature, smoke_temperature, real_power,
-                 last_set_air_temperature, last_set_power, idle_info=None):
-        self.__device_id = device_id
-        self.__device_status = device_status
-        self.__device_status_human = device_status_human
-        self.__air_temperature = air_temperature
-        self.__smoke_temperature = smoke_temperature
-        self.__real_power = real_power
-        self.__last_set_air_temperature = last_set_air_temperature
-        self.__last_set_power = last_set_power
-        self.__idle_info = idle_info
-
-    @property
-    def device_id(self):
-        return self.__device_id
-
-    @property
-    def device_status(self):
-        return self.__device_status
-
-    @property
-    def device_status_human(self):
-        return self.__device_status_human
-
-    @property
-    def air_temperature(self):
-        return self.__air_temperature
-
-    @property
-    def smoke_temperature(self):
-        return self.__smoke_temperature
-
-    @property
-    def real_power(self):
-        return self.__real_power
-
-    @property
-    def last_set_air_temperature(self):
-        return self.__last_set_air_temperature
-
-    @property
-    def last_set_power(self):
-        return self.__last_set_power
-
-    @property
-    def idle_info(self):
-        return self.__idle_info
+# namedtuple(defaults=...) needs Python 3.7
+Device.__new__.__defaults__ = (None,)
 
 
 class Error(Exception):
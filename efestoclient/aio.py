@@ -0,0 +1,296 @@
+"""AsyncEfestoClient provides asyncio based controlling of Efesto heat devices
+"""
+import asyncio
+import time
+
+import aiohttp
+
+from . import (
+    HEADER, RETRY_STATUSES, ConnectionError, EfestoClient, Error,
+    InvalidURLError, UnauthorizedError, _backoff_delay,
+    _check_parameters_result, _check_result, _endpoints, _parameters_payload,
+    _parse_status, _webcall_payload, _webcall_result
+)
+
+
+class AsyncEfestoClient(object):
+    """Provides asyncio access to Efesto.
+
+    Login happens on the first webcall, or upfront when the client is
+    built with the create() coroutine. Several devices can be polled
+    concurrently on a single event loop.
+    """
+
+    statusTranslated = EfestoClient.statusTranslated
+    SYSTEM_MODES = EfestoClient.SYSTEM_MODES
+
+    def __init__(self, url, username, password, deviceid, status_ttl=5.0,
+                 max_retries=3, backoff=0.25, cap=2.0):
+        """AsyncEfestoClient object constructor"""
+        self.url = url
+        self.username = username
+        self.password = password
+        self.deviceid = deviceid
+
+        self._login_url, self._ajax_url, self._referer = \
+            _endpoints(url, deviceid)
+
+        self._payload_state = _webcall_payload('get-state', deviceid)
+        self._payload_off = _webcall_payload('heater-off', deviceid)
+        self._payload_on = _webcall_payload('heater-on', deviceid)
+
+        self.phpsessid = None
+        self.remember = None
+
+        self._status_ttl = status_ttl
+        self._status_cache = (0.0, None)
+        self._status_generation = 0
+        # Created on first use, before Python 3.10 asyncio locks bind to
+        # the event loop current at creation time
+        self._status_lock = None
+
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._cap = cap
+
+        # Created on first use, like the status lock and the session
+        self._login_lock = None
+        # Created on first use, aiohttp wants a running event loop
+        self._session = None
+
+    @classmethod
+    async def create(cls, *args, **kwargs):
+        """Create a client and login to Efesto"""
+        self = cls(*args, **kwargs)
+        try:
+            await self._login()
+        except Exception:
+            await self.close()
+            raise
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        """Close the HTTP session and its pooled connections"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(ssl=False, limit=10,
+                                               keepalive_timeout=75),
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+                headers=dict(HEADER, Origin=self.url, Referer=self._referer))
+        return self._session
+
+    def _get_status_lock(self):
+        if self._status_lock is None:
+            self._status_lock = asyncio.Lock()
+        return self._status_lock
+
+    def _get_login_lock(self):
+        if self._login_lock is None:
+            self._login_lock = asyncio.Lock()
+        return self._login_lock
+
+    async def _login(self):
+        await self.sessionid()
+        await self.login()
+
+    async def _ensure_logged_in(self):
+        async with self._get_login_lock():
+            if self.remember is None:
+                await self._login()
+
+    async def _relogin(self, remember):
+        async with self._get_login_lock():
+            # Skip when another webcall already logged in again meanwhile
+            if self.remember != remember:
+                return
+            # The new cookies replace the old ones in the session cookie jar
+            phpsessid = self.phpsessid
+            try:
+                await self._login()
+            except Error:
+                # Keep the old session, so the next webcall does not turn an
+                # outage into a failed initial login.
+                self.phpsessid = phpsessid
+                self.remember = remember
+                raise
+
+    async def sessionid(self):
+        """Get PHP session information"""
+
+        url = self._login_url
+
+        session = self._get_session()
+        try:
+            async with session.get(url) as resp:
+                resp.raise_for_status()
+                cookie = resp.cookies.get("PHPSESSID")
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            raise ConnectionError(str.format("Connection to {0} not possible", url))
+        except aiohttp.ClientError:
+            raise InvalidURLError(str.format("Invalid Efesto url: {0}", url))
+
+        self.phpsessid = cookie.value if cookie is not None else None
+
+        return self.phpsessid
+
+    async def login(self):
+        """Authenticate with username and password to Efesto"""
+
+        url = self._login_url
+
+        payload = {
+            'login[username]': self.username,
+            'login[password]': self.password
+        }
+
+        session = self._get_session()
+        try:
+            async with session.post(url, data=payload,
+                                    allow_redirects=False) as resp:
+                resp.raise_for_status()
+                cookie = resp.cookies.get("remember")
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            raise ConnectionError(str.format("Connection to {0} not possible", url))
+        except aiohttp.ClientError:
+            raise InvalidURLError(str.format("Invalid Efesto url: {0}", url))
+
+        self.remember = cookie.value if cookie is not None else None
+
+        if self.remember is None:
+            raise UnauthorizedError('Failed to login, please check credentials')
+
+        return self.remember
+
+    def cache_clear(self):
+        """Invalidate the cached stove status"""
+        # Polls already in flight see the new generation and do not store
+        # their possibly outdated result.
+        self._status_generation += 1
+        self._status_cache = (0.0, None)
+
+    def get_system_modes(self):
+        """Get tuple of system modes"""
+        return self.SYSTEM_MODES
+
+    async def _post(self, url, payload, retry):
+        """Post a webcall, returns a (status, body) tuple
+
+        The status is None when connecting failed and retry is allowed.
+        """
+        session = self._get_session()
+        try:
+            async with session.post(url, data=payload,
+                                    allow_redirects=False) as resp:
+                if resp.status == 200:
+                    return resp.status, await resp.read()
+                return resp.status, None
+        except aiohttp.ClientConnectorError:
+            # Nothing was sent yet, so retrying cannot apply a command twice
+            if retry:
+                return None, None
+            raise ConnectionError(str.format("Connection to {0} not possible", url))
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            raise ConnectionError(str.format("Connection to {0} not possible", url))
+        except aiohttp.ClientError:
+            raise InvalidURLError(str.format("Invalid Efesto url: {0}", url))
+
+    async def _retry_webcall(self, url, payload, result):
+        for attempt in range(self._max_retries):
+            if result[0] is not None and result[0] not in RETRY_STATUSES:
+                break
+            await asyncio.sleep(_backoff_delay(self._backoff, self._cap, attempt))
+            result = await self._post(url, payload,
+                                      attempt + 1 < self._max_retries)
+        return result
+
+    async def handle_webcall(self, url, payload):
+        if self.remember is None:
+            await self._ensure_logged_in()
+
+        retry = self._max_retries > 0
+        remember = self.remember
+        result = await self._post(url, payload, retry)
+        if result[0] == 302:
+            # Efesto also redirects when the session expired, so login again
+            # before spending the retry budget on the webcall.
+            try:
+                await self._relogin(remember)
+            except Error:
+                return _webcall_result(302, None)
+            result = await self._post(url, payload, retry)
+
+        status_code, body = await self._retry_webcall(url, payload, result)
+
+        return _webcall_result(status_code, body)
+
+    async def get_status(self):
+        """Get stove status, cached for status_ttl seconds"""
+
+        async with self._get_status_lock():
+            now = time.monotonic()
+            if (self._status_cache[1] is not None
+                    and now - self._status_cache[0] < self._status_ttl):
+                return self._status_cache[1]
+
+            generation = self._status_generation
+            device = await self._fetch_status()
+            if generation == self._status_generation:
+                self._status_cache = (now, device)
+
+            return device
+
+    async def _fetch_status(self):
+        res = await self.handle_webcall(self._ajax_url, self._payload_state)
+        return _parse_status(self.deviceid, res, self.statusTranslated)
+
+    async def set_off(self):
+        """Turn stove off"""
+
+        try:
+            res = await self.handle_webcall(self._ajax_url, self._payload_off)
+        finally:
+            self.cache_clear()
+        _check_result(res)
+
+        return True
+
+    async def set_on(self):
+        """Turn stove on"""
+
+        try:
+            res = await self.handle_webcall(self._ajax_url, self._payload_on)
+        finally:
+            self.cache_clear()
+        _check_result(res)
+
+        return True
+
+    async def set_parameters(self, *, air_temperature=None, power=None):
+        """Set desired room temperature and/or power value in one call"""
+
+        payload = _parameters_payload(self.deviceid, air_temperature, power)
+
+        try:
+            res = await self.handle_webcall(self._ajax_url, payload)
+        finally:
+            self.cache_clear()
+        _check_parameters_result(res)
+
+    async def set_temperature(self, temperatureValue):
+        """Set desired room temperature"""
+        await self.set_parameters(air_temperature=temperatureValue)
+
+    async def set_power(self, powerValue):
+        """Set desired power value"""
+        await self.set_parameters(power=powerValue)
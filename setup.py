@@ -13,6 +13,10 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/fredericvl/efestoclient",
     packages=setuptools.find_packages(),
+    extras_require={
+        "aio": ["aiohttp"],
+        "speedups": ["orjson"],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: Apache Software License",